@@ -1,13 +1,16 @@
+import asyncio
+import json
 import logging # Добавляем импорт
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
 from research_logic import perform_deep_research
-from typing import List, Optional, Dict, Any
-import json
+from typing import List, Optional
 from utils.file_utils import generate_result_files, setup_file_logging, save_research_result
+from utils import llm, scraper
 
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO, # Уровень логирования (INFO, DEBUG, WARNING, ERROR, CRITICAL)
@@ -39,6 +42,18 @@ app = FastAPI(
 )
 logger.info("FastAPI приложение инициализировано.")
 
+@app.on_event("startup")
+async def startup_event():
+    # Создаем общий HTTP-клиент скрапера заранее, а не на первом запросе
+    scraper.get_client()
+    logger.info("Общий HTTP-клиент скрапера инициализирован.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scraper.close_client()
+    scraper.shutdown_executor()
+    logger.info("Общий HTTP-клиент и пул парсинга скрапера остановлены.")
+
 # Модель запроса Pydantic
 class ResearchRequest(BaseModel):
     query: str = Field(..., description="Основной запрос для исследования")
@@ -46,101 +61,106 @@ class ResearchRequest(BaseModel):
     breadth: int = Field(default=3, ge=1, le=5, description="Ширина исследования (количество направлений/запросов на шаге)")
     existing_learnings: Optional[List[str]] = Field(None, description="Опциональный список существующих знаний")
 
-# Модель ответа Pydantic
-class ResearchResponse(BaseModel):
-    result_file: str = Field(..., description="Путь к файлу с результатами исследования")
-    error: Optional[str] = Field(None, description="Описание ошибки, если она возникла")
+def _sse_event(event: str, data: dict) -> str:
+    """Форматирует одно событие Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-@app.post("/research", response_model=ResearchResponse)
+@app.post("/research")
 async def run_research(request: ResearchRequest):
     """
     Запускает процесс глубокого исследования.
+
+    Возвращает поток Server-Sent Events: события прогресса (depth_start,
+    queries, scraped, depth_done) приходят по мере выполнения итераций, затем
+    событие report с итоговым отчетом и done с путем к файлу результата.
+    Клиент видит первые байты через секунды, а не после всего исследования.
     """
     # Генерируем имена файлов для результатов
     result_file, log_file = generate_result_files()
-    
-    # Настраиваем логирование в файл
-    setup_file_logging(log_file)
-    
+
+    # Настраиваем логирование в файл на время этого исследования
+    stop_file_logging = setup_file_logging(log_file)
+
     logger.info(f"Получен запрос на исследование: query='{request.query}', depth={request.depth}, breadth={request.breadth}")
-    try:
-        report, sources, conclusions, directions = await perform_deep_research(
-            initial_query=request.query,
-            depth=request.depth,
-            breadth=request.breadth,
-            existing_learnings=request.existing_learnings
-        )
-        
-        # Формируем итоговый отчет
-        final_report = await generate_final_report(request.query, sources, {
-            "report": report,
-            "conclusions": conclusions,
-            "directions": directions
-        })
-        
-        if not final_report:
-            raise ValueError("Не удалось сгенерировать итоговый отчет")
-        
-        # Добавляем заголовок к отчету
-        header = """исследование создано с помощью canfly-avrora-deepresearch и содержит в себе информацию из открытых источников. 2005-2025 (С) canfly | культура твоего сознания
+
+    # События прогресса из perform_deep_research передаются клиенту через очередь
+    events_queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_event(event: str, data: dict) -> None:
+        await events_queue.put((event, data))
+
+    async def run_and_publish() -> None:
+        try:
+            report, sources, conclusions, directions = await perform_deep_research(
+                initial_query=request.query,
+                depth=request.depth,
+                breadth=request.breadth,
+                existing_learnings=request.existing_learnings,
+                on_event=on_event
+            )
+
+            # Итоговый отчет уже сгенерирован внутри perform_deep_research;
+            # повторная генерация здесь стоила бы лишний полный вызов Gemini
+            if not report:
+                raise ValueError("Не удалось сгенерировать итоговый отчет")
+
+            # Добавляем заголовок к отчету
+            header = """исследование создано с помощью canfly-avrora-deepresearch и содержит в себе информацию из открытых источников. 2005-2025 (С) canfly | культура твоего сознания
 
 ---
 """
-        final_report = header + final_report
-        
-        # Сохраняем результаты в файл
-        save_research_result(result_file, final_report)
-            
-        logger.info(f"Исследование для запроса '{request.query}' успешно завершено.")
-        return ResearchResponse(result_file=result_file)
-    except Exception as e:
-        error_msg = f"Произошла ошибка во время исследования для запроса '{request.query}': {str(e)}"
-        logger.exception(error_msg)
-        return ResearchResponse(result_file="", error=error_msg)
+            # Список источников модель по инструкции не включает — добавляем сами
+            sources_section = ""
+            if sources:
+                sources_section = "\n\n## Источники\n" + "\n".join(f"- {source}" for source in sources)
+
+            final_report = header + report + sources_section
+
+            # Сохраняем результаты в файл
+            await save_research_result(result_file, final_report)
+
+            logger.info(f"Исследование для запроса '{request.query}' успешно завершено.")
+            await events_queue.put(("report", {"text": final_report}))
+            await events_queue.put(("done", {"result_file": result_file}))
+        except Exception as e:
+            error_msg = f"Произошла ошибка во время исследования для запроса '{request.query}': {str(e)}"
+            logger.exception(error_msg)
+            await events_queue.put(("error", {"message": error_msg}))
+        finally:
+            # Снимаем файловый обработчик этого исследования и закрываем файл
+            stop_file_logging()
+            await events_queue.put(None) # Сентинел конца потока
+
+    async def event_generator():
+        research_task = asyncio.create_task(run_and_publish())
+        try:
+            while True:
+                item = await events_queue.get()
+                if item is None:
+                    break
+                event, data = item
+                yield _sse_event(event, data)
+        finally:
+            # Клиент отключился до завершения — останавливаем исследование
+            if not research_task.done():
+                research_task.cancel()
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 @app.get("/")
 async def root():
     logger.debug("Запрос к корневому эндпоинту /")
     return {"message": "Deep Research API запущен"}
 
-async def generate_final_report(query: str, sources: List[str], research_data: Dict[str, Any]) -> str:
-    """Генерирует итоговый отчет на основе собранных данных."""
-    try:
-        # Создаем промпт для генерации отчета
-        prompt = f"""На основе следующей информации создайте подробный отчет:
-
-Запрос: {query}
-
-Источники:
-{chr(10).join(f'- {source}' for source in sources)}
-
-Основные выводы:
-{chr(10).join(f'- {conclusion}' for conclusion in research_data["conclusions"])}
-
-Направления для дальнейшего исследования:
-{chr(10).join(f'- {direction}' for direction in research_data["directions"])}
-
-Создайте структурированный отчет, который включает:
-1. Краткое введение
-2. Основные выводы
-3. Подробный анализ
-4. Заключение
-
-Отчет должен быть информативным и хорошо структурированным."""
-
-        # Инициализируем модель Gemini
-        model = genai.GenerativeModel('gemini-2.0-pro-exp')
-        
-        # Генерируем отчет с помощью Gemini
-        response = await model.generate_content_async(prompt)
-        
-        if not response or not response.text:
-            raise ValueError("Не удалось получить ответ от модели")
-            
-        return response.text
-    except Exception as e:
-        logger.error(f"Ошибка при генерации итогового отчета: {e}")
-        return f"Произошла ошибка при генерации отчета: {str(e)}"
+@app.get("/cache/stats")
+async def cache_stats():
+    """Возвращает статистику семантического кэша ответов LLM."""
+    logger.debug("Запрос к эндпоинту /cache/stats")
+    return {
+        "enabled": llm.response_cache.enabled,
+        "hits": llm.response_cache.stats["hits"],
+        "misses": llm.response_cache.stats["misses"],
+    }
 
 # Если этот файл запускается напрямую (для отладки, хотя обычно используется uvicorn)
 if __name__ == "__main__":
@@ -1,16 +1,79 @@
 import asyncio
-from typing import List, Tuple, Dict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from utils import search, scraper, llm # Импортируем наши модули
 
+# Подписчик на события прогресса: (имя события, данные события)
+EventCallback = Callable[[str, Dict], Awaitable[None]]
+
+
+async def _emit(on_event: Optional[EventCallback], event: str, data: Dict) -> None:
+    """Отправляет событие прогресса подписчику, если он задан."""
+    if on_event is None:
+        return
+    try:
+        await on_event(event, data)
+    except Exception as e:
+        print(f"Ошибка обработчика события '{event}': {e}")
+
+# Порог схожести по Жаккару, выше которого документ считается дубликатом
+DUPLICATE_JACCARD_THRESHOLD = 0.8
+
+
+def _shingle_hashes(text: str, n: int = 5) -> set:
+    """Множество хэшей n-грамм слов для грубой оценки схожести документов."""
+    words = text.lower().split()
+    if len(words) < n:
+        return {hash(' '.join(words))}
+    return {hash(' '.join(words[i:i + n])) for i in range(len(words) - n + 1)}
+
+
+def _combine_scraped_texts(scraped_data: List[Dict[str, str]], max_chars: int) -> str:
+    """
+    Собирает тексты источников в один блок для анализатора.
+
+    Простая конкатенация с последующей обрезкой до лимита молча выбрасывала все
+    источники после первых одного-двух. Вместо этого:
+    - почти дублирующиеся документы (схожесть по 5-граммам выше порога)
+      отбрасываются — это шаблонный мусор вроде кук-баннеров и навигации;
+    - лимит символов делится поровну между оставшимися источниками, чтобы в
+      анализ попало начало каждого из них.
+    """
+    included_texts: List[str] = []
+    included_shingles: List[set] = []
+    for item in scraped_data:
+        shingles = _shingle_hashes(item['text'])
+        is_duplicate = False
+        for prev_shingles in included_shingles:
+            union_size = len(shingles | prev_shingles)
+            if union_size and len(shingles & prev_shingles) / union_size > DUPLICATE_JACCARD_THRESHOLD:
+                is_duplicate = True
+                break
+        if is_duplicate:
+            print(f"Источник {item['url']} почти дублирует уже включенный, пропускается.")
+            continue
+        included_texts.append(item['text'])
+        included_shingles.append(shingles)
+
+    if not included_texts:
+        return ""
+
+    quota = max_chars // len(included_texts)
+    return "\n\n---\n\n".join(text[:quota] for text in included_texts)
+
+
 async def perform_deep_research(
     initial_query: str,
     depth: int,
     breadth: int,
-    existing_learnings: List[str] = None
+    existing_learnings: List[str] = None,
+    on_event: Optional[EventCallback] = None
 ) -> Tuple[str, List[str], List[str], List[str]]:
     """
     Выполняет итеративное глубокое исследование.
 
+    Через on_event (если задан) отправляются события прогресса по мере
+    прохождения итераций — клиент видит ход исследования, не дожидаясь конца.
+
     Возвращает:
         Tuple[str, List[str], List[str], List[str]]: Кортеж (Итоговый отчет в Markdown, Список источников, Список выводов, Список направлений)
     """
@@ -22,77 +85,142 @@ async def perform_deep_research(
     all_sources = []
     current_query_context = initial_query
     final_directions = []
-
-    for i in range(depth):
-        print(f"--- Глубина {i+1}/{depth} ---")
-
-        # 1. Генерация поисковых запросов с помощью Gemini
-        print("Генерация поисковых запросов...")
-        search_queries = await llm.generate_search_queries(
-            current_query_context,
-            all_learnings,
-            breadth
-        )
-        print(f"Сгенерировано запросов: {search_queries}")
-
-        # 2. Поиск ссылок для каждого запроса
-        urls_to_scrape = []
-        search_tasks = [search.find_urls(query, num_results=2) for query in search_queries]
-        results = await asyncio.gather(*search_tasks)
-        for urls in results:
-            for url in urls:
-                if url not in visited_urls:
-                    urls_to_scrape.append(url)
-                    visited_urls.add(url)
-
-        if not urls_to_scrape:
-            print("Не найдено новых URL для исследования на этом шаге.")
-            continue
-
-        print(f"Найдено {len(urls_to_scrape)} уникальных URL для скрапинга.")
-
-        # 3. Асинхронный скрапинг контента со страниц
-        print("Скрапинг контента...")
-        scrape_tasks = [scraper.scrape_content(url) for url in urls_to_scrape]
-        scraped_results = await asyncio.gather(*scrape_tasks, return_exceptions=True)
-
-        scraped_data : List[Dict[str, str]] = []
-        successful_urls = []
-        for result in scraped_results:
-            if isinstance(result, dict) and result.get('text'):
-                scraped_data.append(result)
-                successful_urls.append(result['url'])
-            elif isinstance(result, Exception):
-                print(f"Ошибка скрапинга: {result}")
-
-        if not scraped_data:
-            print("Не удалось извлечь контент ни с одной страницы на этом шаге.")
-            continue
-
-        print(f"Успешно извлечен контент с {len(scraped_data)} страниц.")
-        all_sources.extend(successful_urls)
-
-        # 4. Обработка контента и генерация новых направлений
-        print("Анализ контента и генерация выводов...")
-        combined_text = "\n\n---\n\n".join([item['text'] for item in scraped_data])
-
-        summary_and_directions = await llm.summarize_and_find_directions(
-            current_query_context,
-            all_learnings,
-            combined_text
-        )
-
-        new_learnings = summary_and_directions.get("learnings", [])
-        next_directions = summary_and_directions.get("directions", [])
-
-        print(f"Новые выводы: {new_learnings}")
-        print(f"Следующие направления: {next_directions}")
-
-        all_learnings.extend(new_learnings)
-        final_directions = next_directions  # Сохраняем последние направления
-
-    # 6. Формирование итогового отчета
-    print("Формирование итогового отчета...")
-    final_report = await llm.generate_final_report(initial_query, all_learnings)
-
-    return final_report, list(set(all_sources)), all_learnings, final_directions
\ No newline at end of file
+    final_report = None
+    used_queries: List[str] = []
+
+    # Явный контекстный кэш Gemini: системная инструкция анализатора и стартовый
+    # контекст исследования повторяются на каждой итерации глубины
+    context_cache = await llm.create_analysis_cache(initial_query, existing_learnings)
+
+    # Конвейер LLM-вызовов: генерация запросов следующей итерации зависит только от
+    # all_learnings (не от next_directions), поэтому её можно запускать параллельно
+    # с анализом текущей итерации — минус один последовательный вызов LLM на уровень
+    pending_queries_task = asyncio.create_task(
+        llm.generate_search_queries(current_query_context, list(all_learnings), breadth)
+    )
+
+    try:
+        for i in range(depth):
+            print(f"--- Глубина {i+1}/{depth} ---")
+            await _emit(on_event, "depth_start", {"depth": i + 1, "total": depth})
+
+            # 1. Генерация поисковых запросов (задача запущена на предыдущей итерации)
+            print("Генерация поисковых запросов...")
+            search_queries = await pending_queries_task
+            pending_queries_task = None
+            used_queries.extend(search_queries)
+            print(f"Сгенерировано запросов: {search_queries}")
+            await _emit(on_event, "queries", {"depth": i + 1, "queries": search_queries})
+
+            # 2. Поиск ссылок для каждого запроса
+            urls_to_scrape = []
+            search_tasks = [search.find_urls(query, num_results=2) for query in search_queries]
+            results = await asyncio.gather(*search_tasks)
+            for urls in results:
+                for url in urls:
+                    if url not in visited_urls:
+                        urls_to_scrape.append(url)
+                        visited_urls.add(url)
+
+            if not urls_to_scrape:
+                print("Не найдено новых URL для исследования на этом шаге.")
+                if i < depth - 1:
+                    pending_queries_task = asyncio.create_task(
+                        llm.generate_search_queries(
+                            current_query_context, list(all_learnings), breadth,
+                            previous_queries=list(used_queries), use_cache=False
+                        )
+                    )
+                continue
+
+            print(f"Найдено {len(urls_to_scrape)} уникальных URL для скрапинга.")
+
+            # 3. Асинхронный скрапинг контента со страниц
+            print("Скрапинг контента...")
+            scrape_tasks = [scraper.scrape_content(url) for url in urls_to_scrape]
+            scraped_results = await asyncio.gather(*scrape_tasks, return_exceptions=True)
+
+            scraped_data : List[Dict[str, str]] = []
+            successful_urls = []
+            for result in scraped_results:
+                if isinstance(result, dict) and result.get('text'):
+                    scraped_data.append(result)
+                    successful_urls.append(result['url'])
+                elif isinstance(result, Exception):
+                    print(f"Ошибка скрапинга: {result}")
+
+            if not scraped_data:
+                print("Не удалось извлечь контент ни с одной страницы на этом шаге.")
+                if i < depth - 1:
+                    pending_queries_task = asyncio.create_task(
+                        llm.generate_search_queries(
+                            current_query_context, list(all_learnings), breadth,
+                            previous_queries=list(used_queries), use_cache=False
+                        )
+                    )
+                continue
+
+            print(f"Успешно извлечен контент с {len(scraped_data)} страниц.")
+            # visited_urls гарантирует, что URL не скрапится дважды,
+            # поэтому all_sources уже не содержит дубликатов
+            all_sources.extend(successful_urls)
+            await _emit(on_event, "scraped", {"depth": i + 1, "urls": successful_urls})
+
+            # 4. Обработка контента и генерация новых направлений
+            print("Анализ контента и генерация выводов...")
+            combined_text = _combine_scraped_texts(scraped_data, llm.MAX_ANALYZE_CHARS)
+
+            # Анализ текущей итерации и генерация запросов следующей идут параллельно.
+            # На последней итерации тем же вызовом генерируется и итоговый отчет —
+            # минус один полный round trip к Gemini
+            summary_task = asyncio.create_task(llm.summarize_and_find_directions(
+                current_query_context,
+                all_learnings,
+                combined_text,
+                cached_content=context_cache,
+                include_report=(i == depth - 1)
+            ))
+            if i < depth - 1:
+                # Передаем уже использованные запросы и отключаем кэш ответов:
+                # иначе промпт совпадает с предыдущим и кэш вернул бы тот же
+                # список запросов, превращая следующую итерацию в no-op
+                pending_queries_task = asyncio.create_task(
+                    llm.generate_search_queries(
+                        current_query_context, list(all_learnings), breadth,
+                        previous_queries=list(used_queries), use_cache=False
+                    )
+                )
+
+            summary_and_directions = await summary_task
+
+            new_learnings = summary_and_directions.get("learnings", [])
+            next_directions = summary_and_directions.get("directions", [])
+            report = summary_and_directions.get("report")
+            if isinstance(report, str) and report.strip():
+                final_report = report
+
+            print(f"Новые выводы: {new_learnings}")
+            print(f"Следующие направления: {next_directions}")
+
+            all_learnings.extend(new_learnings)
+            final_directions = next_directions  # Сохраняем последние направления
+            await _emit(on_event, "depth_done", {
+                "depth": i + 1,
+                "learnings": new_learnings,
+                "directions": next_directions,
+            })
+    finally:
+        # Не оставляем "висящую" задачу генерации запросов при выходе из цикла по ошибке
+        if pending_queries_task is not None and not pending_queries_task.done():
+            pending_queries_task.cancel()
+        # Удаляем кэш сразу, чтобы не платить за его хранение после завершения запроса
+        await llm.delete_context_cache(context_cache)
+
+    # 6. Формирование итогового отчета (отдельным вызовом — только если он не был
+    # получен вместе с последним анализом, например когда последняя итерация
+    # завершилась без нового контента)
+    if final_report is None:
+        print("Формирование итогового отчета...")
+        final_report = await llm.generate_final_report(initial_query, all_learnings)
+
+    return final_report, all_sources, all_learnings, final_directions
\ No newline at end of file
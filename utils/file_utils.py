@@ -1,8 +1,13 @@
+import asyncio
 import os
-import hashlib
+import queue
+import secrets
 from datetime import datetime
 import logging
-from typing import Tuple
+import logging.handlers
+from typing import Callable, Tuple
+
+import aiofiles
 
 def generate_result_files() -> Tuple[str, str]:
     """
@@ -12,13 +17,11 @@ def generate_result_files() -> Tuple[str, str]:
         Tuple[str, str]: (путь к файлу результатов, путь к файлу логов)
     """
     # Создаем директорию results если её нет
-    if not os.path.exists('results'):
-        os.makedirs('results')
-    
-    # Генерируем timestamp и hash
+    os.makedirs('results', exist_ok=True)
+
+    # Генерируем timestamp и случайный суффикс
     timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-    hash_input = f"{timestamp}-{os.urandom(8).hex()}"
-    file_hash = hashlib.md5(hash_input.encode()).hexdigest()[:8]
+    file_hash = secrets.token_hex(4)
     
     # Формируем имена файлов
     result_file = f"results/result-{timestamp}-{file_hash}.md"
@@ -26,37 +29,68 @@ def generate_result_files() -> Tuple[str, str]:
     
     return result_file, log_file
 
-def setup_file_logging(log_file: str) -> None:
+def setup_file_logging(log_file: str) -> Callable[[], None]:
     """
-    Настраивает логирование в файл.
-    
+    Настраивает логирование в файл через очередь на время одного исследования.
+
+    Записи проходят через QueueHandler (дешевый put в очередь из event loop),
+    а на диск их пишет QueueListener в фоновом потоке — синхронный emit
+    файлового обработчика не блокирует loop на каждую запись.
+
     Args:
         log_file: путь к файлу логов
+
+    Returns:
+        Функция остановки: снимает обработчик, останавливает листенер и
+        закрывает файл. Вызывается в finally по завершении исследования —
+        обработчики не накапливаются в корневом логгере и не текут дескрипторы.
     """
     # Создаем форматтер для логов
     formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
-    
+
     # Создаем handler для файла
     file_handler = logging.FileHandler(log_file, encoding='utf-8')
     file_handler.setFormatter(formatter)
-    
+
+    # Очередь без лимита + фоновый поток записи
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+
     # Получаем корневой логгер и добавляем handler
     root_logger = logging.getLogger()
-    root_logger.addHandler(file_handler)
-    
+    root_logger.addHandler(queue_handler)
+
     # Устанавливаем уровень логирования
     root_logger.setLevel(logging.INFO)
 
-def save_research_result(result_file: str, content: str) -> None:
+    def stop_file_logging() -> None:
+        root_logger.removeHandler(queue_handler)
+        listener.stop()
+        file_handler.close()
+
+    return stop_file_logging
+
+async def save_research_result(result_file: str, content: str) -> None:
     """
-    Сохраняет результаты исследования в файл.
-    
+    Асинхронно сохраняет результаты исследования в файл.
+
+    Пишет во временный файл и атомарно переименовывает его: запись на диск не
+    блокирует event loop, а при сбое не остается полузаписанный файл результата.
+
     Args:
         result_file: путь к файлу результатов
         content: содержимое для сохранения
     """
-    with open(result_file, 'w', encoding='utf-8') as f:
-        f.write(content) 
\ No newline at end of file
+    tmp_file = result_file + ".tmp"
+    async with aiofiles.open(tmp_file, 'w', encoding='utf-8') as f:
+        await f.write(content)
+        await f.flush()
+        # fileno у aiofiles — обычный синхронный метод (proxy_method_directly)
+        fd = f.fileno()
+        await asyncio.to_thread(os.fsync, fd)
+    os.replace(tmp_file, result_file) 
\ No newline at end of file
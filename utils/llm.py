@@ -1,12 +1,22 @@
 # utils/llm.py
+import asyncio
+import datetime
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as api_exceptions
 import os
 import logging
-from typing import List, Dict, Any
-import json # Для парсинга JSON ответов
+from typing import List, Dict, Any, Optional
+# pydantic (через который genai конвертирует схемы) требует typing_extensions.TypedDict на Python < 3.12
+from typing_extensions import TypedDict
+import orjson # Быстрый парсер JSON ответов (C-расширение)
+from utils.semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
+# Семантический кэш ответов: повторные и похожие промпты не ходят в сеть
+response_cache = SemanticCache(enabled=True)
+
 # --- Настройка модели Gemini ---
 # API ключ уже должен быть настроен в main.py
 # Выбираем модель. 'gemini-1.5-flash' - быстрая и недорогая модель
@@ -22,6 +32,15 @@ generation_config = {
     # "response_mime_type": "application/json", # Если хотим строго JSON
 }
 
+# Схемы структурированного вывода анализатора: Gemini гарантирует валидный JSON
+# этой формы, что убирает целый класс ошибок парсинга
+class AnalyzeResult(TypedDict):
+    learnings: List[str]
+    directions: List[str]
+
+class AnalyzeResultWithReport(AnalyzeResult):
+    report: str
+
 safety_settings = [ # Настройки безопасности
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
@@ -42,7 +61,15 @@ try:
     system_instruction_analyze = """Ты - ИИ-аналитик исследований. Твоя задача - анализировать текст, извлекать ключевые выводы и предлагать новые направления для исследования. Отвечай ТОЛЬКО в формате JSON."""
     model_analyze = genai.GenerativeModel(
         model_name=MODEL_NAME,
-        generation_config={"response_mime_type": "application/json", **generation_config}, # Требуем JSON
+        generation_config={"response_mime_type": "application/json", "response_schema": AnalyzeResult, **generation_config}, # Требуем JSON по схеме
+        safety_settings=safety_settings,
+        system_instruction=system_instruction_analyze
+    )
+
+    # Вариант анализатора для последней итерации: схема дополнительно содержит отчет
+    model_analyze_report = genai.GenerativeModel(
+        model_name=MODEL_NAME,
+        generation_config={"response_mime_type": "application/json", "response_schema": AnalyzeResultWithReport, **generation_config},
         safety_settings=safety_settings,
         system_instruction=system_instruction_analyze
     )
@@ -61,15 +88,87 @@ except Exception as e:
     # Это приведет к ошибке при запуске, но лучше знать сразу
     raise
 
-async def _call_gemini_api(prompt: str, model: genai.GenerativeModel) -> str:
-    """Вспомогательная функция для вызова API Gemini с обработкой ошибок."""
+# TTL явного контекстного кэша: чуть дольше типичной длительности одного исследования
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=10)
+
+# Ограничение размера текста для анализа (в символах), чтобы не превышать лимиты модели
+MAX_ANALYZE_CHARS = 100000
+
+# Ограничение параллельных вызовов Gemini: без него всплеск одновременных запросов
+# упирается в лимиты API и превращается в шторм ретраев с ростом P99 латентности
+_llm_semaphore = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "8")))
+
+# Параметры повторов при превышении квоты (429 / ResourceExhausted)
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 2.0 # Секунды, растет экспоненциально с каждым повтором
+
+async def create_analysis_cache(context: str, learnings: List[str]) -> Optional[caching.CachedContent]:
+    """
+    Создаёт явный контекстный кэш Gemini для анализатора.
+
+    Системная инструкция и стартовый контекст исследования повторяются в каждом
+    вызове summarize_and_find_directions на всех итерациях depth; явный кэш
+    даёт скидку на эти токены и снижает латентность. Возвращает None, если кэш
+    создать не удалось (например, префикс короче минимально допустимого размера).
+    """
+    contents = [context]
+    if learnings:
+        contents.append("\n".join(learnings))
+    try:
+        cached_content = await asyncio.to_thread(
+            caching.CachedContent.create,
+            model=MODEL_NAME,
+            system_instruction=system_instruction_analyze,
+            contents=contents,
+            ttl=CONTEXT_CACHE_TTL,
+        )
+        logger.info(f"Создан контекстный кэш Gemini: {cached_content.name}")
+        return cached_content
+    except Exception as e:
+        logger.warning(f"Не удалось создать контекстный кэш Gemini (работаем без него): {e}")
+        return None
+
+async def delete_context_cache(cached_content: Optional[caching.CachedContent]) -> None:
+    """Удаляет явный контекстный кэш, чтобы не платить за его хранение после завершения запроса."""
+    if cached_content is None:
+        return
+    try:
+        await asyncio.to_thread(cached_content.delete)
+        logger.info(f"Контекстный кэш Gemini удален: {cached_content.name}")
+    except Exception as e:
+        logger.warning(f"Не удалось удалить контекстный кэш Gemini: {e}")
+
+async def _call_gemini_api(
+    prompt: str,
+    model: genai.GenerativeModel,
+    namespace: str = "default",
+    use_cache: bool = True
+) -> str:
+    """Вспомогательная функция для вызова API Gemini с обработкой ошибок и кэшированием."""
     logger.debug(f"Вызов Gemini API. Длина промпта: {len(prompt)} символов.")
+    if use_cache:
+        cached_response = await response_cache.get(namespace, prompt)
+        if cached_response is not None:
+            logger.info(f"Ответ взят из семантического кэша (namespace={namespace}).")
+            return cached_response
     try:
-        response = await model.generate_content_async(prompt)
+        async with _llm_semaphore:
+            for attempt in range(MAX_RETRIES):
+                try:
+                    response = await model.generate_content_async(prompt)
+                    break
+                except api_exceptions.ResourceExhausted as e:
+                    if attempt == MAX_RETRIES - 1:
+                        raise
+                    delay = RETRY_BASE_DELAY * (2 ** attempt)
+                    logger.warning(f"Квота Gemini исчерпана (429), повтор через {delay:.0f} с: {e}")
+                    await asyncio.sleep(delay)
         # Проверка на наличие текста в ответе
         if response.parts:
             result_text = response.text
             logger.debug(f"Gemini API ответил. Длина ответа: {len(result_text)} символов.")
+            if use_cache:
+                await response_cache.put(namespace, prompt, result_text)
             return result_text
         else:
             # Если Gemini заблокировал ответ из-за safety settings или по другой причине
@@ -79,8 +178,27 @@ async def _call_gemini_api(prompt: str, model: genai.GenerativeModel) -> str:
         logger.exception(f"Ошибка при вызове Gemini API: {e}")
         raise # Передаем ошибку выше
 
-async def generate_search_queries(context: str, learnings: List[str], breadth: int) -> List[str]:
-    """Генерирует поисковые запросы с помощью Gemini."""
+async def generate_search_queries(
+    context: str,
+    learnings: List[str],
+    breadth: int,
+    previous_queries: Optional[List[str]] = None,
+    use_cache: bool = True
+) -> List[str]:
+    """
+    Генерирует поисковые запросы с помощью Gemini.
+
+    previous_queries — запросы, уже использованные в этом исследовании: модель
+    не должна их повторять (и это делает промпты итераций различными).
+    use_cache=False отключает семантический кэш — нужно для повторных генераций
+    внутри одного исследования, где закэшированный ответ вернул бы те же запросы.
+    """
+    previous_queries_block = ""
+    if previous_queries:
+        previous_queries_block = f"""
+**Уже использованные поисковые запросы (не повторяй их и не перефразируй):**
+{previous_queries}
+"""
     prompt = f"""
 Основываясь на следующем контексте исследования и уже полученных выводах, сгенерируй {breadth} новых, разнообразных и конкретных поисковых запросов для Google, чтобы углубить исследование.
 
@@ -89,7 +207,7 @@ async def generate_search_queries(context: str, learnings: List[str], breadth: i
 
 **Уже известные выводы (последние 5):**
 {learnings[-5:] if learnings else "Пока нет"}
-
+{previous_queries_block}
 **Задача:**
 Сгенерируй ровно {breadth} поисковых запроса. Каждый запрос должен быть на новой строке, без нумерации или маркеров. Не добавляй никаких объяснений или вступлений, только сами запросы.
 
@@ -98,19 +216,41 @@ async def generate_search_queries(context: str, learnings: List[str], breadth: i
 Применение кубитов в медицине
 Сравнение ионных ловушек и сверхпроводящих кубитов
 """
-    response_text = await _call_gemini_api(prompt, model_search)
+    response_text = await _call_gemini_api(prompt, model_search, namespace="search", use_cache=use_cache)
     queries = [q.strip() for q in response_text.split('\n') if q.strip()]
     logger.info(f"Сгенерированные запросы из ответа Gemini: {queries}")
     # Возьмем не больше breadth запросов, если модель дала больше
     return queries[:breadth]
 
-async def summarize_and_find_directions(context: str, learnings: List[str], text_to_analyze: str) -> Dict[str, List[str]]:
-    """Анализирует текст, извлекает выводы и направления в формате JSON."""
+async def summarize_and_find_directions(
+    context: str,
+    learnings: List[str],
+    text_to_analyze: str,
+    cached_content: Optional[caching.CachedContent] = None,
+    include_report: bool = False
+) -> Dict[str, Any]:
+    """
+    Анализирует текст, извлекает выводы и направления в формате JSON.
+
+    При include_report=True тем же вызовом генерируется и итоговый отчет
+    (поле "report"): микробатчинг двух промптов с общими входными данными
+    экономит один полный round trip к Gemini на исследование.
+    """
     # Ограничим размер текста, чтобы не превышать лимиты (очень грубое ограничение)
-    max_input_chars = 100000 # Примерный лимит, нужно смотреть актуальные для модели
-    if len(text_to_analyze) > max_input_chars:
-        logger.warning(f"Текст для анализа ({len(text_to_analyze)} символов) слишком большой, обрезается до {max_input_chars}.")
-        text_to_analyze = text_to_analyze[:max_input_chars]
+    if len(text_to_analyze) > MAX_ANALYZE_CHARS:
+        logger.warning(f"Текст для анализа ({len(text_to_analyze)} символов) слишком большой, обрезается до {MAX_ANALYZE_CHARS}.")
+        text_to_analyze = text_to_analyze[:MAX_ANALYZE_CHARS]
+
+    report_field = ""
+    report_instructions = ""
+    if include_report:
+        report_field = ',\n  "report": "Итоговый отчет в формате Markdown"'
+        report_instructions = f"""
+Дополнительно верни поле `report` — подробный структурированный итоговый отчет в формате Markdown по ВСЕМ выводам исследования (уже известным и новым). Отчет должен:
+- начинаться с заголовка `# Исследование по запросу: {context}`;
+- содержать краткое введение, основные выводы с подзаголовками (`##`) и списками, раздел `## Заключение`;
+- связывать выводы в единый текст, а не просто перечислять их;
+- не включать список источников, он будет добавлен отдельно."""
 
     prompt = f"""
 Проанализируй следующий текст, полученный в ходе веб-исследования.
@@ -139,41 +279,37 @@ async def summarize_and_find_directions(context: str, learnings: List[str], text
     "Конкретный вопрос для дальнейшего исследования, возникший из текста",
     "Направление для углубления, связанное с темой",
     "..."
-  ]
+  ]{report_field}
 }}
 Избегай дублирования выводов, которые уже есть в `learnings`. Сосредоточься на новой информации из `Текст для анализа`.
 Выводы (`learnings`) должны быть краткими утверждениями.
 Направления (`directions`) должны быть вопросами или темами для дальнейшего поиска.
-Если текст не содержит полезной информации, верни пустые списки.
+Если текст не содержит полезной информации, верни пустые списки.{report_instructions}
 """
-    response_text = await _call_gemini_api(prompt, model_analyze)
+    response_schema = AnalyzeResultWithReport if include_report else AnalyzeResult
+
+    # Если для этого исследования создан явный контекстный кэш, используем модель,
+    # привязанную к нему: системная инструкция и стартовый контекст не тарифицируются заново
+    if cached_content is not None:
+        model = genai.GenerativeModel.from_cached_content(
+            cached_content=cached_content,
+            generation_config={"response_mime_type": "application/json", "response_schema": response_schema, **generation_config},
+            safety_settings=safety_settings
+        )
+    else:
+        model = model_analyze_report if include_report else model_analyze
+
+    response_text = await _call_gemini_api(prompt, model, namespace="analyze")
 
     try:
-        # Попытка распарсить JSON
-        result_json = json.loads(response_text)
-        # Проверка структуры
-        if isinstance(result_json, dict) and \
-           isinstance(result_json.get("learnings"), list) and \
-           isinstance(result_json.get("directions"), list):
-            logger.info(f"Успешно извлечены выводы: {result_json.get('learnings')}, направления: {result_json.get('directions')}")
-            return result_json
-        else:
-            logger.warning(f"Gemini вернул некорректный JSON: {response_text}")
-            return {"learnings": [], "directions": []}
-    except json.JSONDecodeError:
-        logger.error(f"Не удалось распарсить JSON ответ от Gemini: {response_text}")
-        # Попытка извлечь хоть что-то (очень грубо)
-        learnings_guess = []
-        directions_guess = []
-        if '"learnings": [' in response_text:
-            # Простая попытка извлечь строки из списка learnings
-            pass # Добавить логику извлечения если нужно
-        if '"directions": [' in response_text:
-             # Простая попытка извлечь строки из списка directions
-            pass # Добавить логику извлечения если нужно
-        return {"learnings": learnings_guess, "directions": directions_guess}
+        # Схема structured output гарантирует валидный JSON нужной формы,
+        # поэтому эвристики восстановления из битого ответа больше не нужны
+        result_json = orjson.loads(response_text)
+        logger.info(f"Успешно извлечены выводы: {result_json.get('learnings')}, направления: {result_json.get('directions')}")
+        return result_json
     except Exception as e:
-        logger.exception(f"Неожиданная ошибка при обработке ответа Gemini: {e}")
+        # Пустой ответ (например, блокировка safety settings) или обрыв генерации
+        logger.exception(f"Не удалось обработать ответ Gemini: {e}")
         return {"learnings": [], "directions": []}
 
 async def generate_final_report(query: str, all_learnings: List[str]) -> str:
@@ -204,5 +340,5 @@ async def generate_final_report(query: str, all_learnings: List[str]) -> str:
 7.  Не включай список источников, он будет добавлен отдельно.
 8.  Сделай отчет понятным и информативным.
 """
-    report = await _call_gemini_api(prompt, model_report)
+    report = await _call_gemini_api(prompt, model_report, namespace="report")
     return report if report else f"# Отчет не сгенерирован\n\nGemini не вернул текст отчета.\n\nСобранные выводы:\n" + "\n".join(f"- {l}" for l in all_learnings)
\ No newline at end of file
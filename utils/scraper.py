@@ -1,69 +1,157 @@
 # utils/scraper.py
 import asyncio
+import concurrent.futures
 import logging
+import os
 from typing import Dict, Optional
 import httpx # Асинхронный HTTP клиент
-from bs4 import BeautifulSoup # Для парсинга HTML
+from selectolax.parser import HTMLParser # Быстрый HTML-парсер (C-расширение)
 
 logger = logging.getLogger(__name__)
 
 # Настройки для HTTP запросов
 REQUEST_TIMEOUT = 15 # Секунды
+# Accept-Encoding не задаем вручную: httpx сам рекламирует ровно те кодеки
+# (gzip/deflate, br при установленном brotli), которые умеет распаковывать
 HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
 
-async def scrape_content(url: str) -> Optional[Dict[str, str]]:
+# Лимиты на скачиваемый HTML: анализатор всё равно обрезает текст до лимита символов,
+# поэтому хвост большой страницы — чистый расход памяти и трафика
+# CSS-селекторы для извлечения текста: собраны один раз на уровне модуля,
+# а не на каждый вызов парсера
+_STRIP_SELECTOR = 'script, style, nav, footer, header, aside, form'
+_TEXT_SELECTOR = 'p, h1, h2, h3, h4, h5, h6, li'
+
+MAX_HTML_BYTES = 512 * 1024 # Читаем не больше 512КБ на страницу
+MAX_CONTENT_LENGTH = 2 * 1024 * 1024 # Отказ сразу, если заявленный размер больше 2МБ
+CHUNK_SIZE = 16384 # Размер чанка при потоковом чтении
+
+# Общий HTTP-клиент: соединения (TCP+TLS) переиспользуются между скрапами,
+# вместо рукопожатия на каждый URL. Создается лениво, закрывается при остановке приложения.
+_client: Optional[httpx.AsyncClient] = None
+
+# Ограничение параллельности скрапинга, чтобы не упереться в дескрипторы и tail latency
+MAX_CONCURRENT_SCRAPES = 32
+_scrape_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SCRAPES)
+
+
+def get_client() -> httpx.AsyncClient:
+    """Возвращает общий AsyncClient, создавая его при первом обращении."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers=HEADERS,
+            timeout=REQUEST_TIMEOUT,
+            follow_redirects=True,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True, # Мультиплексирование запросов к одному хосту
+                retries=1, # Один повтор при transient-ошибке установки соединения
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            ),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """Закрывает общий HTTP-клиент (вызывается при остановке приложения)."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+# Пул процессов для парсинга HTML: из-за GIL парсинг N страниц в потоках почти
+# не масштабируется, а в отдельных процессах задействует все ядра
+_executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+
+def _get_executor() -> concurrent.futures.ProcessPoolExecutor:
+    """Возвращает общий пул процессов для парсинга, создавая его при первом обращении."""
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _executor
+
+
+def shutdown_executor() -> None:
+    """Останавливает пул процессов парсинга (вызывается при остановке приложения)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def _parse_html(html_content: str, url: str) -> Optional[str]:
     """
-    Асинхронно скачивает и извлекает основной текстовый контент со страницы.
+    Извлекает основной текстовый контент из HTML.
+
+    Чисто CPU-bound функция: выполняется в пуле процессов, чтобы парсинг N
+    страниц шел на всех ядрах и не блокировал event loop.
+    """
+    tree = HTMLParser(html_content)
+
+    if tree.body is None:
+        logger.warning(f"Не найден тег <body> на странице {url}. Пропуск.")
+        return None
+
+    # --- Стратегия извлечения текста ---
+    # Удаляем ненужные теги (скрипты, стили, навигацию, футеры и т.д.)
+    for element in tree.css(_STRIP_SELECTOR):
+        element.decompose()
+
+    # Извлекаем текст из основных тегов контента (простая эвристика)
+    # Можно улучшить: искать тег <article>, <main>, или div с определенными классами
+    text_parts = []
+    for node in tree.css(_TEXT_SELECTOR):
+        # Получаем текст, убираем лишние пробелы и пустые строки
+        cleaned_text = ' '.join(node.text(separator=' ', strip=True).split())
+        if cleaned_text:
+            text_parts.append(cleaned_text)
+
+    return "\n".join(text_parts)
+    # ------------------------------------
+
+
+async def fetch_html(url: str) -> Optional[str]:
+    """
+    Скачивает HTML страницы (чистый I/O, без парсинга).
 
     Args:
-        url: URL страницы для скрапинга.
+        url: URL страницы.
 
     Returns:
-        Словарь {'url': url, 'text': extracted_text} или None в случае ошибки.
+        Декодированный HTML или None в случае ошибки.
     """
     logger.info(f"Попытка скрапинга URL: {url}")
     try:
-        async with httpx.AsyncClient(headers=HEADERS, follow_redirects=True, timeout=REQUEST_TIMEOUT) as client:
-            response = await client.get(url)
-            response.raise_for_status() # Проверяем на ошибки HTTP (4xx, 5xx)
-
-            content_type = response.headers.get("content-type", "").lower()
-            if "html" not in content_type:
-                logger.warning(f"Контент по URL {url} не является HTML (тип: {content_type}). Пропуск.")
-                return None
-
-            html_content = response.text
-            soup = BeautifulSoup(html_content, 'lxml') # Используем lxml парсер, он быстрее
-
-            # --- Стратегия извлечения текста ---
-            # Удаляем ненужные теги (скрипты, стили, навигацию, футеры и т.д.)
-            for element in soup(["script", "style", "nav", "footer", "header", "aside", "form"]):
-                element.decompose()
-
-            # Извлекаем текст из основных тегов контента (простая эвристика)
-            # Можно улучшить: искать тег <article>, <main>, или div с определенными классами
-            body = soup.find('body')
-            if not body:
-                logger.warning(f"Не найден тег <body> на странице {url}. Пропуск.")
-                return None
-
-            # Собираем текст из параграфов, заголовков и списков внутри body
-            text_parts = []
-            for tag in body.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li']):
-                 # Получаем текст, убираем лишние пробелы и пустые строки
-                cleaned_text = ' '.join(tag.get_text(separator=' ', strip=True).split())
-                if cleaned_text:
-                    text_parts.append(cleaned_text)
-
-            extracted_text = "\n".join(text_parts)
-            # ------------------------------------
-
-            if not extracted_text:
-                logger.warning(f"Не удалось извлечь текст со страницы {url} после парсинга.")
-                return None
-
-            logger.info(f"Успешно извлечено ~{len(extracted_text)} символов с {url}")
-            return {"url": url, "text": extracted_text}
+        async with _scrape_semaphore:
+            client = get_client()
+            async with client.stream("GET", url) as response:
+                response.raise_for_status() # Проверяем на ошибки HTTP (4xx, 5xx)
+
+                content_type = response.headers.get("content-type", "").lower()
+                if "html" not in content_type:
+                    logger.warning(f"Контент по URL {url} не является HTML (тип: {content_type}). Пропуск.")
+                    return None
+
+                # Ранний отказ по заявленному размеру, до скачивания тела
+                content_length = response.headers.get("content-length", "")
+                if content_length.isdigit() and int(content_length) > MAX_CONTENT_LENGTH:
+                    logger.warning(f"Страница {url} слишком большая ({content_length} байт). Пропуск.")
+                    return None
+
+                # Читаем потоково и останавливаемся на лимите: не держим в памяти
+                # мегабайты HTML, из которых анализатор всё равно возьмёт только начало
+                raw_bytes = bytearray()
+                async for chunk in response.aiter_bytes(chunk_size=CHUNK_SIZE):
+                    raw_bytes.extend(chunk)
+                    if len(raw_bytes) >= MAX_HTML_BYTES:
+                        logger.debug(f"Достигнут лимит {MAX_HTML_BYTES} байт для {url}, остаток не скачивается.")
+                        break
+
+                encoding = response.charset_encoding or 'utf-8'
+
+        return raw_bytes.decode(encoding, errors='replace')
 
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP ошибка {e.response.status_code} при доступе к {url}: {e}")
@@ -73,6 +161,38 @@ async def scrape_content(url: str) -> Optional[Dict[str, str]]:
         logger.error(f"Ошибка запроса к {url}: {e}")
         return None
     except Exception as e:
-        # Другие возможные ошибки (например, при парсинге BeautifulSoup)
-        logger.exception(f"Неожиданная ошибка при скрапинге {url}: {e}")
-        return None # Возвращаем None при любой другой ошибке
\ No newline at end of file
+        logger.exception(f"Неожиданная ошибка при скачивании {url}: {e}")
+        return None # Возвращаем None при любой другой ошибке
+
+
+async def scrape_content(url: str) -> Optional[Dict[str, str]]:
+    """
+    Асинхронно скачивает и извлекает основной текстовый контент со страницы.
+
+    Скачивание — чистый I/O в event loop, извлечение текста — CPU-bound работа
+    в общем пуле процессов, поэтому при параллельном скрапинге N страниц
+    парсинг идет на всех ядрах, а loop остается отзывчивым.
+
+    Args:
+        url: URL страницы для скрапинга.
+
+    Returns:
+        Словарь {'url': url, 'text': extracted_text} или None в случае ошибки.
+    """
+    html_content = await fetch_html(url)
+    if html_content is None:
+        return None
+
+    try:
+        loop = asyncio.get_running_loop()
+        extracted_text = await loop.run_in_executor(_get_executor(), _parse_html, html_content, url)
+    except Exception as e:
+        logger.exception(f"Неожиданная ошибка при парсинге {url}: {e}")
+        return None
+
+    if not extracted_text:
+        logger.warning(f"Не удалось извлечь текст со страницы {url} после парсинга.")
+        return None
+
+    logger.info(f"Успешно извлечено ~{len(extracted_text)} символов с {url}")
+    return {"url": url, "text": extracted_text}
@@ -2,7 +2,7 @@
 import asyncio
 import logging
 from typing import List
-from duckduckgo_search import DDGS # Используем асинхронную версию
+from duckduckgo_search import DDGS
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +23,13 @@ async def find_urls(query: str, num_results: int = 3) -> List[str]:
     logger.info(f"Выполнение поиска по запросу: '{query}', желаемое кол-во результатов: {num_results}")
     urls = []
     try:
+        # DDGS().text() — синхронный сетевой вызов; выполняем его в пуле потоков,
+        # иначе он блокирует event loop и параллельные запросы через asyncio.gather
+        # фактически выполняются последовательно (AsyncDDGS удален из библиотеки в 7.0)
         ddgs = DDGS(headers=HEADERS, timeout=10)
-        results = ddgs.text(query, max_results=num_results * 2)
-        
-        for r in results:
+        results = await asyncio.to_thread(ddgs.text, query, max_results=num_results * 2)
+
+        for r in results or []:
             if r and isinstance(r, dict) and 'href' in r:
                 urls.append(r['href'])
                 if len(urls) >= num_results:
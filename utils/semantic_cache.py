@@ -0,0 +1,173 @@
+# utils/semantic_cache.py
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+# Модель для получения эмбеддингов промптов (дешёвая и быстрая по сравнению с генерацией)
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Отдельный лимит параллельности для эмбеддингов: вызовы кэша не должны
+# стоять в одной очереди с генерацией и наоборот
+_embed_semaphore = asyncio.Semaphore(int(os.getenv("GEMINI_EMBED_CONCURRENCY", "8")))
+
+
+class SemanticCache:
+    """
+    Семантический кэш ответов Gemini.
+
+    Двухуровневая схема:
+    1. Точное совпадение по sha256 промпта (быстрый путь, без сетевых вызовов).
+    2. Поиск по косинусной близости эмбеддингов: если похожий промпт уже
+       встречался (similarity > порога), возвращаем сохранённый ответ.
+
+    Записи разделены по пространствам имён (namespace), чтобы ответы
+    разных моделей (search/analyze/report) не перемешивались.
+    Записи устаревают по TTL и вытесняются по LRU при переполнении.
+
+    Промпты длиннее max_embed_chars участвуют только в точном поиске: окно
+    эмбеддинг-модели (~2048 токенов) вместило бы лишь префикс промпта, а у
+    промптов анализатора префикс — это общий блок контекста и выводов, так что
+    "похожесть" префиксов давала бы ложные попадания на совершенно разных текстах.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        similarity_threshold: float = 0.92,
+        ttl_seconds: float = 3600.0,
+        max_entries: int = 256,
+        max_embed_chars: int = 8000,
+    ):
+        self.enabled = enabled
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_embed_chars = max_embed_chars
+        # Ключ: (namespace, sha256 промпта) -> {"embedding", "response", "expires_at"}
+        self._entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        # Эмбеддинги, посчитанные в get(), чтобы не считать их заново в put()
+        self._pending_embeddings: Dict[Tuple[str, str], List[float]] = {}
+        self._lock = asyncio.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def _hash_prompt(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _cosine_similarity(a: List[float], b: List[float]) -> float:
+        dot = sum(x * y for x, y in zip(a, b))
+        norm_a = math.sqrt(sum(x * x for x in a))
+        norm_b = math.sqrt(sum(x * x for x in b))
+        if norm_a == 0.0 or norm_b == 0.0:
+            return 0.0
+        return dot / (norm_a * norm_b)
+
+    async def _embed(self, text: str) -> List[float]:
+        """Получает эмбеддинг текста через Gemini API."""
+        async with _embed_semaphore:
+            result = await genai.embed_content_async(
+                model=EMBEDDING_MODEL,
+                content=text,
+                task_type="semantic_similarity",
+            )
+        return result["embedding"]
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
+
+    async def get(self, namespace: str, prompt: str) -> Optional[str]:
+        """Возвращает закэшированный ответ или None при промахе."""
+        if not self.enabled:
+            return None
+
+        key = (namespace, self._hash_prompt(prompt))
+
+        async with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                logger.debug(f"Точное попадание в кэш (namespace={namespace}).")
+                return entry["response"]
+
+        # Длинные промпты не влезают в окно эмбеддинг-модели — только точный поиск
+        if len(prompt) > self.max_embed_chars:
+            logger.debug(f"Промпт ({len(prompt)} символов) слишком длинный для семантического поиска.")
+            self.stats["misses"] += 1
+            return None
+
+        # Семантический поиск: эмбеддинг считается вне блокировки (сетевой вызов)
+        try:
+            embedding = await self._embed(prompt)
+        except Exception as e:
+            logger.warning(f"Не удалось получить эмбеддинг для кэша: {e}")
+            self.stats["misses"] += 1
+            return None
+
+        async with self._lock:
+            # Сохраняем эмбеддинг, чтобы put() не считал его повторно
+            self._pending_embeddings[key] = embedding
+            if len(self._pending_embeddings) > self.max_entries:
+                self._pending_embeddings.pop(next(iter(self._pending_embeddings)))
+
+            best_key = None
+            best_similarity = 0.0
+            for entry_key, entry in self._entries.items():
+                if entry_key[0] != namespace or entry["embedding"] is None:
+                    continue
+                similarity = self._cosine_similarity(embedding, entry["embedding"])
+                if similarity > best_similarity:
+                    best_similarity = similarity
+                    best_key = entry_key
+
+            if best_key is not None and best_similarity >= self.similarity_threshold:
+                self._entries.move_to_end(best_key)
+                self.stats["hits"] += 1
+                logger.info(
+                    f"Семантическое попадание в кэш (namespace={namespace}, similarity={best_similarity:.3f})."
+                )
+                return self._entries[best_key]["response"]
+
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, namespace: str, prompt: str, response: str) -> None:
+        """Сохраняет ответ в кэш."""
+        if not self.enabled or not response:
+            return
+
+        key = (namespace, self._hash_prompt(prompt))
+
+        embedding = self._pending_embeddings.pop(key, None)
+        if embedding is None and len(prompt) <= self.max_embed_chars:
+            try:
+                embedding = await self._embed(prompt)
+            except Exception as e:
+                # Без эмбеддинга запись участвует только в точном поиске
+                logger.warning(f"Не удалось получить эмбеддинг при сохранении в кэш: {e}")
+                embedding = None
+
+        async with self._lock:
+            self._entries[key] = {
+                "embedding": embedding,
+                "response": response,
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+            self._entries.move_to_end(key)
+            # LRU-вытеснение при переполнении
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)